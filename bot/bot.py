@@ -1,18 +1,25 @@
 import os
-import json
+import orjson
+import msgspec
 import time
-import requests
 import discord
-from discord.ext import tasks
+import aiohttp
 import logging
 from aiohttp import web
+from yarl import URL
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import asyncio
 import secrets
 from pathlib import Path
-import upnpclient
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 import socket
+import ipaddress
+import signal
+import functools
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -26,58 +33,294 @@ WG_CLAN_ID = os.getenv("WG_CLAN_ID")
 OAUTH_PORT = int(os.getenv("OAUTH_PORT", "42000"))
 TIME_ZONE = os.getenv("TZ", "Europe/Helsinki")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID"))
+TZ = ZoneInfo(TIME_ZONE)
 
 # OAuth2 Configuration
 TOKEN_FILE = "/app/data/wg_tokens.json"
 RESERVES_STATE_FILE = "/app/data/reserves_state.json"
+UPNP_CACHE_FILE = "/app/data/upnp_cache.json"
+UPNP_TIMEOUT = aiohttp.ClientTimeout(total=5)
+OAUTH_SERVER_TIMEOUT = 3600
+
+# Reserve polling, in seconds
+POLL_INTERVAL = 300
+MIN_POLL_INTERVAL = 60
+
+# WG API circuit breaker
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 1800
+
+# HTTP timeouts
+WG_API_TIMEOUT = aiohttp.ClientTimeout(total=10)
+HTTP_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+class WGServerError(Exception):
+    """WG API answered with a 5xx status"""
+
+# Clan reserves API response
+class Bonus(msgspec.Struct):
+    value: float
+    battle_type: str
+
+class Stock(msgspec.Struct):
+    status: str
+    level: int
+    activated_at: int | None = None
+    active_till: int | None = None
+    bonus_values: list[Bonus] = []
+
+class Reserve(msgspec.Struct):
+    name: str
+    in_stock: list[Stock] = []
+
+class APIError(msgspec.Struct):
+    code: int | None = None
+    message: str | None = None
+
+class ReservesResponse(msgspec.Struct):
+    status: str
+    data: list[Reserve] | None = None
+    error: APIError | None = None
+
+reserves_decoder = msgspec.json.Decoder(ReservesResponse)
+
+# SSDP discovery
+SSDP_ADDR = ('239.255.255.250', 1900)
+SSDP_SEARCH_TARGETS = [
+    "urn:schemas-upnp-org:service:WANIPConnection:1",
+    "urn:schemas-upnp-org:service:WANIPConnection:2",
+    "urn:schemas-upnp-org:device:InternetGatewayDevice:1",
+]
+
+class SSDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+def parse_ssdp_headers(data):
+    headers = {}
+    for line in data.decode(errors='replace').split('\r\n')[1:]:
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    return headers
+
+def get_local_addresses():
+    """Get the local IPv4 addresses to send SSDP searches from"""
+    addresses = {get_local_ip()}
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.add(info[4][0])
+    except OSError:
+        pass
+    addresses = {a for a in addresses if not a.startswith('127.')}
+    return addresses or {'0.0.0.0'}
+
+async def discover_gateway(mx=2):
+    """Find the internet gateway description URL via SSDP"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    transports = []
+
+    # Send every search target from every interface at once
+    for address in get_local_addresses():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            if address != '0.0.0.0':
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+            sock.bind((address, 0))
+            sock.setblocking(False)
+            transport, _ = await loop.create_datagram_endpoint(lambda: SSDPProtocol(queue), sock=sock)
+        except OSError as e:
+            logger.warning(f"Could not send SSDP search from {address}: {e}")
+            sock.close()
+            continue
+        transports.append(transport)
+        for target in SSDP_SEARCH_TARGETS:
+            transport.sendto(
+                "M-SEARCH * HTTP/1.1\r\n"
+                f"HOST: {SSDP_ADDR[0]}:{SSDP_ADDR[1]}\r\n"
+                'MAN: "ssdp:discover"\r\n'
+                f"MX: {mx}\r\n"
+                f"ST: {target}\r\n"
+                "\r\n".encode(),
+                SSDP_ADDR
+            )
+
+    fallback = None
+    deadline = loop.time() + mx
+    try:
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                data = await asyncio.wait_for(queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            headers = parse_ssdp_headers(data)
+            location = headers.get('location')
+            if not location:
+                continue
+            if 'WANIPConnection' in headers.get('usn', '') or 'WANIPConnection' in headers.get('st', ''):
+                return location
+            fallback = fallback or location
+    finally:
+        for transport in transports:
+            transport.close()
+    return fallback
+
+# location -> (service_type, control_url) of the gateway's WANIPConnection service
+_wan_services = {}
 
-def setup_upnp():
+def load_upnp_cache():
+    """Get the gateway location saved by a previous run"""
     try:
-        devices = upnpclient.discover()
-        if not devices:
-            logger.warning("No UPnP devices found")
-            return None
+        if Path(UPNP_CACHE_FILE).exists():
+            with open(UPNP_CACHE_FILE, 'rb') as f:
+                cached = orjson.loads(f.read())
+            location = cached.get('location')
+            if location and cached.get('service_type') and cached.get('control_url'):
+                _wan_services[location] = (cached['service_type'], cached['control_url'])
+            return location
+    except Exception as e:
+        logger.error(f"Error loading UPnP cache: {e}")
+    return None
 
-        device = devices[0]
-        
-        # Get the external IP address
-        external_ip = None
-        for service in device.services:
-            if 'WANIPConnection' in service.service_type:
-                external_ip = service.GetExternalIPAddress()
-                break
-        
+def save_upnp_cache(location):
+    try:
+        os.makedirs(os.path.dirname(UPNP_CACHE_FILE), exist_ok=True)
+        with open(UPNP_CACHE_FILE, 'wb') as f:
+            service_type, control_url = _wan_services.get(location, (None, None))
+            f.write(orjson.dumps({
+                'location': location,
+                'service_type': service_type,
+                'control_url': control_url
+            }))
+    except Exception as e:
+        logger.error(f"Error saving UPnP cache: {e}")
+
+async def setup_upnp(session):
+    """Find the gateway and its external IP, returns (location, external_ip)"""
+    location = load_upnp_cache()
+    if location:
+        logger.info(f"Using cached UPnP device at {location}")
+        external_ip = await get_upnp_external_ip(session, location)
+        if external_ip:
+            return location, external_ip
+        logger.warning("Cached UPnP device unavailable, rediscovering")
+
+    location = await discover_gateway()
+    if not location:
+        logger.warning("No UPnP devices found")
+        return None, None
+    external_ip = await get_upnp_external_ip(session, location)
+    if external_ip:
+        save_upnp_cache(location)
+    return location, external_ip
+
+def xml_local_name(element):
+    return element.tag.rsplit('}', 1)[-1]
+
+def xml_child_text(element, name):
+    for child in element:
+        if xml_local_name(child) == name:
+            return (child.text or '').strip()
+    return None
+
+async def get_wan_service(session, location):
+    """Get the service type and control URL of the gateway's WANIPConnection service"""
+    if location in _wan_services:
+        return _wan_services[location]
+
+    async with session.get(location, timeout=UPNP_TIMEOUT) as response:
+        root = ElementTree.fromstring(await response.read())
+
+    base_url = xml_child_text(root, 'URLBase') or location
+    for element in root.iter():
+        if xml_local_name(element) != 'service':
+            continue
+        service_type = xml_child_text(element, 'serviceType') or ''
+        if 'WANIPConnection' in service_type:
+            _wan_services[location] = (service_type, urljoin(base_url, xml_child_text(element, 'controlURL')))
+            return _wan_services[location]
+    raise Exception(f"No WANIPConnection service found at {location}")
+
+async def upnp_action(session, location, action, **arguments):
+    """Call a SOAP action on the WANIPConnection service and return its output arguments"""
+    service_type, control_url = await get_wan_service(session, location)
+    body = (
+        '<?xml version="1.0"?>'
+        '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+        's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+        f'<s:Body><u:{action} xmlns:u="{service_type}">'
+        + "".join(f"<{k}>{escape(str(v))}</{k}>" for k, v in arguments.items()) +
+        f'</u:{action}></s:Body></s:Envelope>'
+    )
+    headers = {
+        'Content-Type': 'text/xml; charset="utf-8"',
+        'SOAPAction': f'"{service_type}#{action}"'
+    }
+    try:
+        async with session.post(control_url, data=body.encode(), headers=headers, timeout=UPNP_TIMEOUT) as response:
+            content = await response.read()
+            if response.status != 200:
+                raise Exception(f"{action} failed with HTTP {response.status}: {content[:200]}")
+    except Exception:
+        # The router may have moved its control URL, re-read the description next time
+        _wan_services.pop(location, None)
+        raise
+
+    for element in ElementTree.fromstring(content).iter():
+        if xml_local_name(element) == f"{action}Response":
+            return {xml_local_name(child): child.text for child in element}
+    return {}
+
+async def get_upnp_external_ip(session, location):
+    try:
+        result = await upnp_action(session, location, 'GetExternalIPAddress')
+        external_ip = result.get('NewExternalIPAddress')
         if not external_ip:
             logger.warning("Could not get external IP from UPnP")
             return None
-            
         logger.info(f"External IP: {external_ip}")
-        
-        # Try to add port mapping
-        try:
-            for service in device.services:
-                if 'WANIPConnection' in service.service_type:
-                    service.AddPortMapping(
-                        NewRemoteHost='',
-                        NewExternalPort=OAUTH_PORT,
-                        NewProtocol='TCP',
-                        NewInternalPort=OAUTH_PORT,
-                        NewInternalClient=get_local_ip(),
-                        NewEnabled='1',
-                        NewPortMappingDescription='WG OAuth Server',
-                        NewLeaseDuration=0
-                    )
-                    logger.info(f"Successfully mapped port {OAUTH_PORT}")
-                    break
-        except Exception as e:
-            logger.error(f"Failed to map port: {e}")
-            return None
-            
         return external_ip
     except Exception as e:
         logger.error(f"UPnP setup failed: {e}")
         return None
 
+async def add_upnp_port_mapping(session, location):
+    try:
+        await upnp_action(
+            session, location, 'AddPortMapping',
+            NewRemoteHost='',
+            NewExternalPort=OAUTH_PORT,
+            NewProtocol='TCP',
+            NewInternalPort=OAUTH_PORT,
+            NewInternalClient=get_local_ip(),
+            NewEnabled='1',
+            NewPortMappingDescription='WG OAuth Server',
+            NewLeaseDuration=0
+        )
+        logger.info(f"Successfully mapped port {OAUTH_PORT}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to map port: {e}")
+        return False
+
+async def delete_upnp_port_mapping(session, location):
+    try:
+        await upnp_action(
+            session, location, 'DeletePortMapping',
+            NewRemoteHost='',
+            NewExternalPort=OAUTH_PORT,
+            NewProtocol='TCP'
+        )
+        logger.info(f"Removed port mapping for {OAUTH_PORT}")
+    except Exception as e:
+        logger.error(f"Failed to remove port mapping: {e}")
+
+@functools.lru_cache(maxsize=1)
 def get_local_ip():
     """Get local IP address"""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -90,29 +333,50 @@ def get_local_ip():
         s.close()
     return local_ip
 
-def get_public_ip_fallback():
+_public_ip_fallback = None
+
+async def get_public_ip_fallback(session):
     """Fallback method to get public IP if UPnP fails"""
+    global _public_ip_fallback
+    if _public_ip_fallback:
+        return _public_ip_fallback
     try:
-        response = requests.get('https://api.ipify.org')
-        return response.text
+        async with session.get('https://api.ipify.org', timeout=aiohttp.ClientTimeout(total=3)) as response:
+            if response.status != 200:
+                logger.error(f"Failed to get public IP: ipify returned HTTP {response.status}")
+                return None
+            public_ip = (await response.text()).strip()
+        ipaddress.ip_address(public_ip)  # raises ValueError on anything but an address
+        _public_ip_fallback = public_ip
+        return public_ip
     except Exception as e:
         logger.error(f"Failed to get public IP: {e}")
         return None
 
+def is_invalid_token_response(status_code, data):
+    """WG reports bad tokens either as HTTP 401 or as a 401/INVALID_ACCESS_TOKEN error body"""
+    if status_code == 401:
+        return True
+    error = data.error
+    return bool(error) and (error.code == 401 or error.message == 'INVALID_ACCESS_TOKEN')
+
 class WargamingAuth:
     def __init__(self):
         self.access_token = None
         self.refresh_token = None
         self.expires_at = None
         self.state = None
+        self.http = None
+        self._refresh_lock = asyncio.Lock()
+        self._save_lock = asyncio.Lock()
         os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok=True)
         self.load_tokens()
 
     def load_tokens(self):
         try:
             if Path(TOKEN_FILE).exists():
-                with open(TOKEN_FILE, 'r') as f:
-                    data = json.load(f)
+                with open(TOKEN_FILE, 'rb') as f:
+                    data = orjson.loads(f.read())
                     self.access_token = data.get('access_token')
                     self.refresh_token = data.get('refresh_token')
                     self.expires_at = data.get('expires_at')
@@ -122,31 +386,54 @@ class WargamingAuth:
 
     def save_tokens(self):
         try:
-            with open(TOKEN_FILE, 'w') as f:
-                json.dump({
+            with open(TOKEN_FILE, 'wb') as f:
+                f.write(orjson.dumps({
                     'access_token': self.access_token,
                     'refresh_token': self.refresh_token,
                     'expires_at': self.expires_at
-                }, f)
+                }))
                 logger.info("Saved tokens to file")
         except Exception as e:
             logger.error(f"Error saving tokens: {e}")
 
+    def invalidate_access_token(self):
+        self.access_token = None
+        self.expires_at = None
+
+    async def save_tokens_async(self):
+        async with self._save_lock:
+            await asyncio.to_thread(self.save_tokens)
+
+    def token_is_fresh(self, margin=300):
+        return bool(self.access_token and self.expires_at and time.time() < self.expires_at - margin)
+
     async def get_valid_token(self):
-        current_time = time.time()
-        
-        if self.access_token and self.expires_at and current_time < self.expires_at - 300:
+        if self.token_is_fresh():
             return self.access_token
 
-        if self.refresh_token:
-            try:
-                await self.refresh_access_token()
+        async with self._refresh_lock:
+            # Another caller may have refreshed while we waited for the lock
+            if self.token_is_fresh():
                 return self.access_token
-            except Exception as e:
-                logger.error(f"Error refreshing token: {e}")
+
+            if self.refresh_token:
+                try:
+                    await self.refresh_access_token()
+                    return self.access_token
+                except Exception as e:
+                    logger.error(f"Error refreshing token: {e}")
 
         return None
 
+    async def refresh_if_expiring(self, margin):
+        """Refresh the token if it expires within margin seconds, returns True if it was refreshed"""
+        async with self._refresh_lock:
+            # Skip if a concurrent get_valid_token already refreshed it
+            if not self.refresh_token or self.token_is_fresh(margin):
+                return False
+            await self.refresh_access_token()
+            return True
+
     async def refresh_access_token(self):
         url = "https://api.worldoftanks.eu/wot/auth/prolongate/"
         params = {
@@ -154,14 +441,14 @@ class WargamingAuth:
             "refresh_token": self.refresh_token
         }
         
-        response = requests.post(url, params=params)
-        data = response.json()
+        async with self.http.post(url, params=params, timeout=WG_API_TIMEOUT) as response:
+            data = orjson.loads(await response.read())
         
         if data.get("status") == "ok":
             self.access_token = data["data"]["access_token"]
             self.refresh_token = data["data"]["refresh_token"]
-            self.expires_at = time.time() + data["data"]["expires_at"]
-            self.save_tokens()
+            self.expires_at = data["data"]["expires_at"]
+            await self.save_tokens_async()
         else:
             raise Exception(f"Token refresh failed: {data}")
 
@@ -176,15 +463,49 @@ class DiscordBot:
         self.client = discord.Client(intents=intents)
         
         self.last_active_reserves = self.load_reserves_state()
+        self._last_saved_hash = hash(frozenset(self.last_active_reserves.items()))
+        self._save_lock = asyncio.Lock()
         self.web_app = web.Application()
         self.setup_discord_events()
         self.setup_web_routes()
         self.oauth_state = None
-        
+        self.http = None
+        self._refresh_task = None
+        self._poll_task = None
+        self._next_expiry = None
+        self._redirect_task = None
+        self.upnp_location = None
+        self.public_ip = None
+        self.redirect_uri = None
+        self.channel = None
+        self._pending = []
+        self._flush_handle = None
+        self._flush_task = None
+        self._oauth_runner = None
+        self._oauth_mapped = False
+        self._oauth_stop_handle = None
+        self._oauth_stop_task = None
+        self._oauth_server_lock = asyncio.Lock()
+        self._auth_url = None
+        self._auth_url_built_at = 0
+        self._api_failures = 0
+        self._circuit_open_until = 0
+
+    async def setup(self):
+        """Create the shared HTTP session and start resolving the OAuth redirect URI"""
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300),
+            timeout=HTTP_DEFAULT_TIMEOUT
+        )
+        self.auth.http = self.http
+        # UPnP runs in the background so Discord login is not held up by the router
+        self._redirect_task = asyncio.create_task(self._resolve_redirect_uri())
+
+    async def _resolve_redirect_uri(self):
         # Setup public IP and port forwarding
-        self.public_ip = setup_upnp()
+        self.upnp_location, self.public_ip = await setup_upnp(self.http)
         if not self.public_ip:
-            self.public_ip = get_public_ip_fallback()
+            self.public_ip = await get_public_ip_fallback(self.http)
             logger.warning("UPnP failed, using fallback IP detection")
         
         if self.public_ip:
@@ -193,41 +514,89 @@ class DiscordBot:
         else:
             logger.error("Failed to determine public IP")
             raise Exception("Could not determine public IP address")
+        return self.redirect_uri
 
     def load_reserves_state(self):
         """Load previously announced reserves from file"""
         try:
             if Path(RESERVES_STATE_FILE).exists():
-                with open(RESERVES_STATE_FILE, 'r') as f:
-                    data = json.load(f)
-                    return set(data.get('announced_reserves', []))
-            return set()
+                with open(RESERVES_STATE_FILE, 'rb') as f:
+                    data = orjson.loads(f.read())
+                    reserves = {}
+                    for entry in data.get('announced_reserves', []):
+                        if isinstance(entry, str):
+                            # Older state files stored bare "<name>_<activated_at>" ids
+                            reserves[entry] = int(entry.rsplit('_', 1)[1])
+                        else:
+                            reserve_id, activated_at = entry
+                            reserves[reserve_id] = activated_at
+                    return reserves
+            return {}
         except Exception as e:
             logger.error(f"Error loading reserves state: {e}")
-            return set()
+            return {}
 
-    def save_reserves_state(self):
+    def save_reserves_state(self, reserves=None):
         """Save announced reserves to file"""
+        if reserves is None:
+            reserves = self.last_active_reserves
+        state_hash = hash(frozenset(reserves.items()))
+        if state_hash == self._last_saved_hash:
+            return
         try:
             os.makedirs(os.path.dirname(RESERVES_STATE_FILE), exist_ok=True)
-            with open(RESERVES_STATE_FILE, 'w') as f:
-                json.dump({
-                    'announced_reserves': list(self.last_active_reserves)
-                }, f)
+            tmp_file = RESERVES_STATE_FILE + ".tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps({
+                    'announced_reserves': [[k, v] for k, v in reserves.items()]
+                }))
+            os.replace(tmp_file, RESERVES_STATE_FILE)
+            self._last_saved_hash = state_hash
             logger.info("Saved reserves state to file")
         except Exception as e:
             logger.error(f"Error saving reserves state: {e}")
 
-    def cleanup_expired_reserves(self, current_time):
+    async def save_reserves_state_async(self):
+        # Hand the writer a snapshot so the event loop can keep updating the state,
+        # and keep writers from sharing the .tmp file
+        snapshot = dict(self.last_active_reserves)
+        async with self._save_lock:
+            await asyncio.to_thread(self.save_reserves_state, snapshot)
+
+    async def cleanup_expired_reserves(self, current_time):
         """Remove expired reserves from the state"""
-        expired = {
-            reserve_id for reserve_id in self.last_active_reserves
-            if int(reserve_id.split('_')[1]) < current_time - 7200  # 2 hours buffer after expiration
+        cutoff = current_time - 7200  # 2 hours buffer after expiration
+        n_before = len(self.last_active_reserves)
+        self.last_active_reserves = {
+            reserve_id: activated_at for reserve_id, activated_at in self.last_active_reserves.items()
+            if activated_at >= cutoff
         }
-        if expired:
-            self.last_active_reserves -= expired
-            self.save_reserves_state()
-            logger.info(f"Cleaned up {len(expired)} expired reserves from state")
+        expired_count = n_before - len(self.last_active_reserves)
+        if expired_count:
+            await self.save_reserves_state_async()
+            logger.info(f"Cleaned up {expired_count} expired reserves from state")
+
+    def queue_announcement(self, reserves):
+        """Buffer newly activated reserves and post them together after a short delay"""
+        self._pending.extend(reserves)
+        if not self._flush_handle:
+            self._flush_handle = asyncio.get_running_loop().call_later(30, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if not self._pending:
+            return
+        message = "**BONARIT ON PÄÄLLÄ, NYT KAIKKI PELAAMAAN:**\n\n"
+        message += "\n\n".join(self._pending)
+        self._pending = []
+        self._flush_task = asyncio.create_task(self._send_announcement(message))
+
+    async def _send_announcement(self, message):
+        try:
+            if self.channel:
+                await self.channel.send(message)
+        except Exception as e:
+            logger.error(f"Failed to send announcement: {e}")
 
     async def send_admin_message(self, message):
         """Send a message to the admin user"""
@@ -243,10 +612,11 @@ class DiscordBot:
         @self.client.event
         async def on_ready():
             logger.info(f'Logged in as {self.client.user}')
+            self.channel = self.client.get_channel(DISCORD_CHANNEL_ID)
             # Debug info
             for guild in self.client.guilds:
                 logger.info(f'Bot is in guild: {guild.name} (id: {guild.id})')
-                channel = self.client.get_channel(DISCORD_CHANNEL_ID)
+                channel = self.channel
                 if channel:
                     logger.info(f'Found channel: {channel.name} in guild: {guild.name}')
                     # Test permissions
@@ -258,34 +628,110 @@ class DiscordBot:
                 else:
                     logger.info(f'Could not find channel with ID {DISCORD_CHANNEL_ID} in guild {guild.name}')
             
-            self.fetch_and_post_reserves.start()
+            if not self._refresh_task:
+                self._refresh_task = asyncio.create_task(self._refresh_scheduler())
+            if not self._poll_task:
+                self._poll_task = asyncio.create_task(self._poll_reserves())
+
+    async def _refresh_scheduler(self):
+        """Refresh the WG token 10 minutes before it expires"""
+        while True:
+            if not self.auth.refresh_token or not self.auth.expires_at:
+                await asyncio.sleep(600)
+                continue
+
+            delay = max(self.auth.expires_at - time.time() - 600, 0)
+            await asyncio.sleep(delay)
+
+            # The token may have been replaced or invalidated while we slept
+            try:
+                if await self.auth.refresh_if_expiring(600):
+                    logger.info("Proactively refreshed WG access token")
+            except Exception as e:
+                logger.error(f"Scheduled token refresh failed: {e}")
+                await asyncio.sleep(600)
 
     def setup_web_routes(self):
         self.web_app.router.add_get('/callback', self.handle_oauth_callback)
         self.web_app.router.add_get('/callback{tail:.*}', self.handle_oauth_callback)
 
-    async def start_oauth_server(self):
-        runner = web.AppRunner(self.web_app)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', OAUTH_PORT)
-        await site.start()
-        logger.info(f"OAuth callback server started on {self.redirect_uri}")
+    async def _ensure_oauth_server(self):
+        """Start the callback server and port mapping if they are not running"""
+        if self._redirect_task.done() and not self._redirect_task.cancelled() and self._redirect_task.exception():
+            # Startup could not find a public IP, try again now that it is needed
+            self._redirect_task = asyncio.create_task(self._resolve_redirect_uri())
+        await self._redirect_task
+        async with self._oauth_server_lock:
+            if not self._oauth_runner:
+                runner = web.AppRunner(self.web_app)
+                await runner.setup()
+                try:
+                    site = web.TCPSite(runner, '0.0.0.0', OAUTH_PORT)
+                    await site.start()
+                except Exception:
+                    await runner.cleanup()
+                    raise
+                self._oauth_runner = runner
+                logger.info(f"OAuth callback server started on {self.redirect_uri}")
+                if self.upnp_location:
+                    self._oauth_mapped = await add_upnp_port_mapping(self.http, self.upnp_location)
+        # Shut down again if nobody completes the authorization
+        self._schedule_oauth_server_stop(OAUTH_SERVER_TIMEOUT)
+
+    def _schedule_oauth_server_stop(self, delay):
+        if self._oauth_stop_handle:
+            self._oauth_stop_handle.cancel()
+        self._oauth_stop_handle = asyncio.get_running_loop().call_later(delay, self._start_oauth_server_stop)
+
+    def _start_oauth_server_stop(self):
+        self._oauth_stop_handle = None
+        self._oauth_stop_task = asyncio.create_task(self._stop_oauth_server())
+
+    async def _stop_oauth_server(self):
+        async with self._oauth_server_lock:
+            if not self._oauth_runner:
+                return
+            await self._oauth_runner.cleanup()
+            self._oauth_runner = None
+            logger.info("OAuth callback server stopped")
+            if self._oauth_mapped:
+                await delete_upnp_port_mapping(self.http, self.upnp_location)
+                self._oauth_mapped = False
+
+    async def request_reauthorization(self):
+        """DM the admin a fresh authorization link, or why one can't be made"""
+        if self._oauth_runner:
+            # A link sent earlier is still waiting for the admin
+            return
+        try:
+            auth_url = await self.start_oauth_flow()
+        except Exception as e:
+            logger.error(f"Could not start OAuth flow: {e}")
+            await self.send_admin_message(f"❌ Bot needs reauthorization, but the OAuth callback server could not be started: {e}")
+            return
+        await self.send_admin_message(f"🔑 Bot needs reauthorization. Click to authorize: {auth_url}")
 
     async def start_oauth_flow(self):
+        await self._ensure_oauth_server()
+        current_time = time.time()
+        if self._auth_url and current_time - self._auth_url_built_at < 60:
+            return self._auth_url
+
         auth_params = {
             "application_id": WG_APPLICATION_ID,
             "redirect_uri": self.redirect_uri,
             "display": "page",
             "nofollow": "0",
-            "expires_at": "1736027938",
+            "expires_at": str(int(current_time) + 14 * 86400),  # WG rejects more than two weeks ahead
             "response_type": "code token"
         }
         
         auth_url = "https://api.worldoftanks.eu/wot/auth/login/"
-        auth_query = "&".join(f"{k}={requests.utils.quote(str(v))}" for k, v in auth_params.items())
-        full_auth_url = f"{auth_url}?{auth_query}"
+        full_auth_url = str(URL(auth_url).with_query(auth_params))
         
         logger.info(f"Please visit this URL to authorize: {full_auth_url}")
+        self._auth_url = full_auth_url
+        self._auth_url_built_at = current_time
         return full_auth_url
 
     async def handle_oauth_callback(self, request):
@@ -306,12 +752,12 @@ class DiscordBot:
             self.auth.access_token = access_token
             self.auth.refresh_token = refresh_token
             self.auth.expires_at = int(expires_at) if expires_at else (time.time() + 86400)
-            self.auth.save_tokens()
+            await self.auth.save_tokens_async()
             
             logger.info(f"Saved tokens: access={access_token}, refresh={refresh_token}, expires={expires_at}")
+            self._schedule_oauth_server_stop(5)
             
-            channel = self.client.get_channel(DISCORD_CHANNEL_ID)
-            if channel:
+            if self.channel:
                 await self.send_admin_message(f"✅ Successfully authorized bot for WoT account: {nickname}")
                 await self.fetch_and_post_reserves()
             
@@ -321,83 +767,128 @@ class DiscordBot:
             logger.error(f"Error processing callback: {e}")
             return web.Response(text="Error processing authorization", status=500)
 
-    @tasks.loop(minutes=5)
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(2, 30),
+        retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError, WGServerError)),
+        reraise=True
+    )
+    async def request_reserves(self, access_token):
+        url = "https://api.worldoftanks.eu/wot/stronghold/clanreserves/info/"
+        params = {
+            "application_id": WG_APPLICATION_ID,
+            "access_token": access_token,
+            "clan_id": WG_CLAN_ID
+        }
+
+        async with self.http.get(url, params=params, timeout=WG_API_TIMEOUT) as response:
+            if response.status >= 500:
+                raise WGServerError(f"WG API returned HTTP {response.status}")
+            if response.status == 401:
+                return response.status, None
+            return response.status, reserves_decoder.decode(await response.read())
+
+    def next_poll_delay(self):
+        """Poll every 5 minutes, or sooner when a known reserve is about to expire"""
+        delay = POLL_INTERVAL
+        # Ignore stale expiries, they would pin polling to the minimum interval
+        if self._next_expiry and self._next_expiry > time.time():
+            delay = min(delay, self._next_expiry - time.time())
+        return max(MIN_POLL_INTERVAL, min(POLL_INTERVAL, delay))
+
+    async def _poll_reserves(self):
+        while not self.client.is_closed():
+            await self.fetch_and_post_reserves()
+            await asyncio.sleep(self.next_poll_delay())
+
     async def fetch_and_post_reserves(self):
+        # Only a successful fetch below sets a new expiry
+        self._next_expiry = None
         try:
-            # Check token expiration
-            if self.auth.expires_at:
-                time_until_expiry = self.auth.expires_at - time.time()
-                # If token expires in less than 24 hours
-                if time_until_expiry < 86400:  # 24 hours in seconds
-                    await self.send_admin_message(f"⚠️ WoT auth token expires in {int(time_until_expiry/3600)} hours. Click to reauthorize: {await self.start_oauth_flow()}")
-            
             access_token = await self.auth.get_valid_token()
             if not access_token:
-                await self.send_admin_message(f"🔑 Bot needs reauthorization. Click to authorize: {await self.start_oauth_flow()}")
+                await self.request_reauthorization()
                 return
 
             # Clean up expired reserves
-            self.cleanup_expired_reserves(int(time.time()))
-            
-            url = "https://api.worldoftanks.eu/wot/stronghold/clanreserves/info/"
-            params = {
-                "application_id": WG_APPLICATION_ID,
-                "access_token": access_token,
-                "clan_id": WG_CLAN_ID
-            }
-
-            response = requests.get(url, params=params)
-            data = response.json()
-
-            if response.status_code == 200 and "data" in data:
-                reserves = data["data"]
-                current_active = set()
+            await self.cleanup_expired_reserves(int(time.time()))
+
+            if time.time() < self._circuit_open_until:
+                logger.warning("WG API circuit breaker open, skipping fetch")
+                return
+
+            try:
+                status_code, data = await self.request_reserves(access_token)
+                if is_invalid_token_response(status_code, data):
+                    # Token was revoked or expired early, refresh and retry once
+                    logger.warning("WG API rejected the access token, refreshing")
+                    self.auth.invalidate_access_token()
+                    access_token = await self.auth.get_valid_token()
+                    if not access_token:
+                        await self.request_reauthorization()
+                        return
+                    status_code, data = await self.request_reserves(access_token)
+            except (aiohttp.ClientError, asyncio.TimeoutError, WGServerError) as e:
+                self._api_failures += 1
+                if self._api_failures >= CIRCUIT_BREAKER_THRESHOLD:
+                    self._circuit_open_until = time.time() + CIRCUIT_BREAKER_COOLDOWN
+                    logger.error(f"WG API failed {self._api_failures} times in a row, pausing for {CIRCUIT_BREAKER_COOLDOWN}s")
+                logger.error(f"Failed to fetch reserves: {e}")
+                return
+            self._api_failures = 0
+
+            if status_code == 200 and data.data is not None:
+                reserves = data.data
+                current_active = {}
                 newly_activated = []
+                active_till_times = []
                 
                 for reserve in reserves:
-                    name = reserve['name']
-                    stock_info = reserve['in_stock'][0]
-                    status = stock_info['status']
+                    if not reserve.in_stock:
+                        continue
+                    name = reserve.name
+                    stock_info = reserve.in_stock[0]
+                    status = stock_info.status
                     
                     if status == 'active':
-                        reserve_id = f"{name}_{stock_info['activated_at']}"
-                        current_active.add(reserve_id)
+                        if stock_info.activated_at is None or stock_info.active_till is None:
+                            logger.warning(f"Skipping active reserve {name} without activation times")
+                            continue
+                        reserve_id = f"{name}_{stock_info.activated_at}"
+                        current_active[reserve_id] = stock_info.activated_at
+                        if stock_info.active_till:
+                            active_till_times.append(stock_info.active_till)
                         
                         if reserve_id not in self.last_active_reserves:
-                            tz = pytz.timezone(TIME_ZONE)
-                            active_till_dt = datetime.datetime.fromtimestamp(stock_info['active_till'])
-                            active_till_local = active_till_dt.astimezone(tz)
-                            active_till = active_till_local.strftime('%Y-%m-%d %H:%M:%S')
-                            
-                            bonus_text = []
-                            for bonus in stock_info['bonus_values']:
-                                bonus_text.append(f"{bonus['value']}x for {bonus['battle_type']}")
+                            active_till = datetime.datetime.fromtimestamp(stock_info.active_till, tz=TZ).strftime('%Y-%m-%d %H:%M:%S')
                             
-                            reserve_info = f"**{name}** (Level {stock_info['level']})\n" \
-                                         f"• {', '.join(bonus_text)}\n" \
-                                         f"• Active until: {active_till}"
+                            bonus_str = ", ".join(f"{b.value:g}x for {b.battle_type}" for b in stock_info.bonus_values)
+                            reserve_info = f"**{name}** (Level {stock_info.level})\n• {bonus_str}\n• Active until: {active_till}"
                             newly_activated.append(reserve_info)
 
+                self._next_expiry = min(active_till_times, default=None)
+
                 # Update tracking set if there are changes
                 if current_active != self.last_active_reserves:
                     self.last_active_reserves = current_active
-                    self.save_reserves_state()
+                    await self.save_reserves_state_async()
 
                 if newly_activated:
-                    message = "**BONARIT ON PÄÄLLÄ, NYT KAIKKI PELAAMAAN:**\n\n"
-                    message += "\n\n".join(newly_activated)
-
-                    channel = self.client.get_channel(DISCORD_CHANNEL_ID)
-                    if channel:
-                        await channel.send(message)
+                    self.queue_announcement(newly_activated)
                         
         except Exception as e:
             logger.error(f"Error: {str(e)}", exc_info=True)
 
 async def main():
     bot = DiscordBot()
-    await bot.start_oauth_server()
-    await bot.client.start(DISCORD_TOKEN)
+    # SIGHUP forgets the cached local IP, e.g. after a DHCP change
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, get_local_ip.cache_clear)
+    try:
+        await bot.setup()
+        await bot.client.start(DISCORD_TOKEN)
+    finally:
+        if bot.http:
+            await bot.http.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file